@@ -1,4 +1,4 @@
-from flask import Flask, request, jsonify
+from flask import Flask, request, jsonify, g
 from flask_cors import CORS
 from dotenv import load_dotenv
 import os
@@ -9,36 +9,119 @@ from google.oauth2.credentials import Credentials
 from google_auth_oauthlib.flow import InstalledAppFlow
 from google.auth.transport.requests import Request
 from googleapiclient.discovery import build
+from cache import create_cache, MemoryCache
+from tracing import Trace, span, propagate
 import base64
+import click
 import time
 import re
+import math
+import hashlib
+import uuid
+import threading
+import multiprocessing
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, wait, TimeoutError as FutureTimeoutError
 
 # Load environment variables
 load_dotenv()
 
 app = Flask(__name__)
-CORS(app)
+CORS(app, expose_headers=['X-Trace-Id'])
 
 # Gmail API setup
 SCOPES = ['https://www.googleapis.com/auth/gmail.readonly']
 
-# Global variable to track authentication state
-AUTHENTICATED = False
+# Bump whenever parse_gmail_message, extract_email_body or extract_attachment_info
+# change what they produce; `flask --app app reindex` then rebuilds stale records.
+EXTRACTOR_VERSION = 1
+# Fields of a Gmail message kept in the cache and read by the extractor
+RAW_MESSAGE_FIELDS = ('id', 'snippet', 'internalDate', 'payload')
+# Bodies extract_email_body stores when it finds no text; not quotable content
+NO_CONTENT_BODY = "No readable content extracted from email."
+EXTRACTION_ERROR_BODY = "Error extracting email content."
+
+# Log types to drop, e.g. MUTED_LOG_TYPES=EMAIL,DEBUG
+MUTED_LOG_TYPES = set(filter(None, os.getenv('MUTED_LOG_TYPES', '').split(',')))
+
+# Shared by all worker processes (see cache.py). Login state and the reindex
+# checkpoint are pinned so evicting bulk data can never log the user out.
+# Raw Gmail messages are much larger than everything else, so they get their
+# own budget instead of pushing parsed emails and conversations out.
+CACHE = create_cache(
+    pinned=('auth', 'reindex'),
+    budgets={'raw_messages': int(os.getenv('CACHE_RAW_MAX_MB', '1024')) * 1024 * 1024}
+)
+
+# Retrieval planner settings
+PLANNER_DEADLINE = float(os.getenv('PLANNER_DEADLINE_SECONDS', '8'))
+FETCH_WORKERS = int(os.getenv('FETCH_WORKERS', '4'))
+RRF_K = 60
+
+# Seconds to wait for DeepSeek before answering with the local extractive summary
+ANSWER_DEADLINE = float(os.getenv('ANSWER_DEADLINE_SECONDS', '20'))
+# HTTP timeout of the DeepSeek answer call; also the longest answer_deadline a request may ask for
+DEEPSEEK_TIMEOUT = 200
+
+# Emails each worker keeps in its local term index for the "local" candidate source
+LOCAL_INDEX_SIZE = int(os.getenv('LOCAL_INDEX_SIZE', '5000'))
+
+STOP_WORDS = {'what', 'where', 'when', 'why', 'how', 'show', 'find', 'emails', 'email',
+              'the', 'and', 'for', 'from', 'with', 'about', 'any', 'are', 'was', 'which',
+              'that', 'this', 'have', 'has', 'did', 'does', 'you', 'your', 'all', 'last'}
+
+# This worker's inverted index over the emails it has seen: term -> {message_id: weight}
+TERM_INDEX = {}
+# message_id -> (internal_date, {term: weight}), least recently seen first
+INDEXED_EMAILS = OrderedDict()
+INDEX_LOCK = threading.Lock()
+
+# Conversation settings
+CONVERSATION_TTL = int(os.getenv('CONVERSATION_TTL_SECONDS', '1800'))
+MAX_HISTORY_TURNS = 6
+# Turns and retrieved email sets kept per conversation; older ones are dropped
+MAX_STORED_TURNS = 20
+MAX_STORED_RETRIEVALS = 5
+
+# Seconds a translated Gmail query stays cached
+TRANSLATION_TTL = int(os.getenv('TRANSLATION_TTL_SECONDS', '3600'))
+# Seconds a DeepSeek answer stays cached for an identical prompt
+ANSWER_TTL = int(os.getenv('ANSWER_TTL_SECONDS', '3600'))
+
+# Tracing: requests slower than this are kept automatically, up to SLOW_TRACE_LIMIT of them
+SLOW_TRACE_SECONDS = float(os.getenv('SLOW_TRACE_SECONDS', '10'))
+SLOW_TRACE_LIMIT = 50
+TRACE_TTL = 3600
 
 def log(message, type="INFO"):
+    if type in MUTED_LOG_TYPES:
+        return
     timestamp = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
     print(f"[{timestamp}] [{type}] {message}")
 
+def set_authenticated(value):
+    """Record the authentication state where every worker can see it"""
+    CACHE.set('auth', 'authenticated', value)
+
+def authenticated_flag():
+    return CACHE.get('auth', 'authenticated', False)
+
+def save_token(creds, token_path='token.json'):
+    """Write the token atomically so other workers never read a half-written file"""
+    temp_path = f"{token_path}.{os.getpid()}.tmp"
+    with open(temp_path, 'w') as token:
+        token.write(creds.to_json())
+    os.replace(temp_path, token_path)
+
 def is_authenticated():
     """Check if user is properly authenticated"""
-    global AUTHENTICATED
-    if not AUTHENTICATED:
+    if not authenticated_flag():
         log("User not authenticated", "AUTH")
         return False
     
     token_path = 'token.json'
     if not os.path.exists(token_path):
-        AUTHENTICATED = False
+        set_authenticated(False)
         log("Token file not found", "AUTH")
         return False
     
@@ -48,19 +131,18 @@ def is_authenticated():
             log("User is authenticated and token is valid", "AUTH")
             return True
         else:
-            AUTHENTICATED = False
+            set_authenticated(False)
             log("Token is invalid or expired", "AUTH")
             return False
     except Exception as e:  # ✅ Add proper exception handling
-        AUTHENTICATED = False
+        set_authenticated(False)
         log(f"Error checking authentication: {e}", "ERROR")
         return False
 
 def get_gmail_service():
     """Authenticate and return Gmail service - only if explicitly authenticated"""
-    global AUTHENTICATED
     
-    if not AUTHENTICATED:
+    if not authenticated_flag():
         log("Cannot get Gmail service - not authenticated", "AUTH")
         return None
     
@@ -72,7 +154,7 @@ def get_gmail_service():
             creds = Credentials.from_authorized_user_file(token_path, SCOPES)
             log("Loaded credentials from token file", "AUTH")
         except:
-            AUTHENTICATED = False
+            set_authenticated(False)
             log(f"Error loading credentials: {e}", "ERROR")
             return None
     
@@ -82,16 +164,15 @@ def get_gmail_service():
                 log("Refreshing expired token", "AUTH")
                 creds.refresh(Request())
             except:
-                AUTHENTICATED = False
+                set_authenticated(False)
                 log(f"Error refreshing token: {e}", "ERROR")
                 return None
         else:
-            AUTHENTICATED = False
+            set_authenticated(False)
             log("No valid credentials available", "AUTH")
             return None
         
-        with open(token_path, 'w') as token:
-            token.write(creds.to_json())
+        save_token(creds, token_path)
         log("Saved refreshed token", "AUTH")
     
     log("Gmail service created successfully", "AUTH")
@@ -120,101 +201,303 @@ def debug_payload_structure(payload, depth=0):
     
     return result
 
-def search_emails(query, max_results=10):
-    """Search emails using Gmail API - with improved content extraction"""
-    try:
-        log(f"Starting email search: '{query}' (max: {max_results} emails)", "SEARCH")
-        start_time = time.time()
-        
-        service = get_gmail_service()
-        
-        if not service:
-            log("Search failed - no Gmail service available", "SEARCH")
-            return None
-        
-        log(f"Executing Gmail API search...", "SEARCH")
+def list_message_ids(query, max_results=10, service=None):
+    """Return Gmail message ids for a search query, in Gmail's ranking order"""
+    service = service or get_gmail_service()
+    if not service:
+        log("Listing failed - no Gmail service available", "SEARCH")
+        return None
+    
+    with span('gmail.list', query=query) as list_span:
         results = service.users().messages().list(
             userId='me', 
             q=query, 
             maxResults=max_results
         ).execute()
-        
-        messages = results.get('messages', [])
-        log(f"Gmail API returned {len(messages)} messages", "SEARCH")
-        
-        email_contents = []
-        
-        for i, message in enumerate(messages):
-            log(f"Processing email {i+1}/{len(messages)}...", "SEARCH")
-            
-            # Get full message content (not just metadata)
-            msg = service.users().messages().get(
-                userId='me', 
-                id=message['id'],
-                format='full'
-            ).execute()
-
-            payload = msg.get('payload', {})
-            
-            log(f"Message keys: {list(msg.keys())}", "DEBUG")
-            log(f"Payload keys: {list(payload.keys())}", "DEBUG")  
+    
+    message_ids = [message['id'] for message in results.get('messages', [])]
+    if list_span:
+        list_span.attrs['results'] = len(message_ids)
+    log(f"Gmail API returned {len(message_ids)} messages for '{query}'", "SEARCH")
+    return message_ids
 
-            if 'parts' in payload:
-                log(f"Number of parts: {len(payload['parts'])}", "DEBUG")
-                for j, part in enumerate(payload['parts']):
-                    log(f"Part {j} mimeType: {part.get('mimeType', 'None')}", "DEBUG")
-            
-            # DEBUG: Print payload structure
-            if i == 0:  # Only for first email to avoid spam
-                log("=== DEBUG PAYLOAD STRUCTURE ===", "DEBUG")
-                debug_lines = debug_payload_structure(payload)
-                for line in debug_lines:
-                    log(line, "DEBUG")
-                log("=== END DEBUG ===", "DEBUG")
-
-            headers = payload.get('headers', [])
-            
-            subject = next((header['value'] for header in headers 
-                          if header['name'] == 'Subject'), 'No Subject')
-            sender = next((header['value'] for header in headers 
-                         if header['name'] == 'From'), 'Unknown Sender')
-            date = next((header['value'] for header in headers 
-                       if header['name'] == 'Date'), 'Unknown Date')
-            
-            # Extract body with improved function
-            body = extract_email_body(payload)
-            
-            # Extract attachment info
-            attachments = extract_attachment_info(payload)
-            
-            internal_date = msg.get('internalDate')
-            
-            email_contents.append({
-                'subject': subject,
-                'sender': sender,
-                'date': date,
-                'internal_date': int(internal_date) if internal_date else 0,
-                'body': body,
-                'snippet': msg.get('snippet', '')[:200] + '...',
-                'message_id': message['id'],
-                'attachments': attachments,
-                'body_length': len(body)
-            })
-            
-            log(f"Email {i+1}: '{subject[:50]}...' | Body: {len(body)} chars | Attachments: {len(attachments)}", "SEARCH")
-        
-        email_contents.sort(key=lambda x: x['internal_date'], reverse=True)
-        search_time = time.time() - start_time
-        
-        total_body_chars = sum(len(email['body']) for email in email_contents)
-        log(f"Email search completed: {len(email_contents)} emails, {total_body_chars} total characters in {search_time:.2f}s", "SEARCH")
+def parse_gmail_message(msg, debug=False):
+    """Turn a full Gmail API message into the email record used everywhere else"""
+    payload = msg.get('payload', {})
+    
+    log(f"Message keys: {list(msg.keys())}", "DEBUG")
+    log(f"Payload keys: {list(payload.keys())}", "DEBUG")  
+
+    if 'parts' in payload:
+        log(f"Number of parts: {len(payload['parts'])}", "DEBUG")
+        for j, part in enumerate(payload['parts']):
+            log(f"Part {j} mimeType: {part.get('mimeType', 'None')}", "DEBUG")
+    
+    # DEBUG: Print payload structure
+    if debug:
+        log("=== DEBUG PAYLOAD STRUCTURE ===", "DEBUG")
+        debug_lines = debug_payload_structure(payload)
+        for line in debug_lines:
+            log(line, "DEBUG")
+        log("=== END DEBUG ===", "DEBUG")
+
+    headers = payload.get('headers', [])
+    
+    subject = next((header['value'] for header in headers 
+                  if header['name'] == 'Subject'), 'No Subject')
+    sender = next((header['value'] for header in headers 
+                 if header['name'] == 'From'), 'Unknown Sender')
+    date = next((header['value'] for header in headers 
+               if header['name'] == 'Date'), 'Unknown Date')
+    
+    # Extract body with improved function
+    body = extract_email_body(payload)
+    
+    # Extract attachment info
+    attachments = extract_attachment_info(payload)
+    
+    internal_date = msg.get('internalDate')
+    
+    log(f"Email '{subject[:50]}...' | Body: {len(body)} chars | Attachments: {len(attachments)}", "SEARCH")
+    
+    return {
+        'subject': subject,
+        'sender': sender,
+        'date': date,
+        'internal_date': int(internal_date) if internal_date else 0,
+        'body': body,
+        'snippet': msg.get('snippet', '')[:200] + '...',
+        'message_id': msg['id'],
+        'attachments': attachments,
+        'body_length': len(body),
+        'extractor_version': EXTRACTOR_VERSION,
+        'content_hash': message_content_hash(msg)
+    }
+
+def message_content_hash(msg):
+    """Hash of the parts of a raw message that extraction reads"""
+    content = json.dumps({field: msg.get(field) for field in RAW_MESSAGE_FIELDS}, sort_keys=True)
+    return hashlib.sha256(content.encode('utf-8')).hexdigest()
+
+def is_stale(record, raw):
+    """True if a parsed record was built by an older extractor or from different content"""
+    return (record is None
+            or record.get('extractor_version') != EXTRACTOR_VERSION
+            or record.get('content_hash') != message_content_hash(raw))
+
+def load_email(message_id):
+    """Return the shared parsed email, re-extracting it from the stored raw message if the extractor changed"""
+    record = CACHE.get('emails', message_id)
+    if record is not None and record.get('extractor_version') == EXTRACTOR_VERSION:
+        index_email(record)
+        return record
+    
+    raw = CACHE.get('raw_messages', message_id)
+    if raw is None:
+        return None
+    
+    with span('extract', message_id=message_id, reprocessed=True):
+        record = parse_gmail_message(raw)
+    CACHE.set('emails', message_id, record)
+    index_email(record, refresh=True)
+    return record
+
+def fetch_email(service, message_id, debug=False):
+    """Fetch and parse one email, reusing the shared parsed copy if there is one"""
+    record = load_email(message_id)
+    if record is not None:
+        return record
+    
+    # Get full message content (not just metadata)
+    with span('gmail.get', message_id=message_id):
+        msg = service.users().messages().get(
+            userId='me', 
+            id=message_id,
+            format='full'
+        ).execute()
+    
+    # Keep the raw message so changed extraction rules can be reapplied without Gmail
+    raw = {field: msg.get(field) for field in RAW_MESSAGE_FIELDS}
+    CACHE.set('raw_messages', message_id, raw)
+    
+    with span('extract', message_id=message_id):
+        email = parse_gmail_message(raw, debug=debug)
+    CACHE.set('emails', message_id, email)
+    index_email(email)
+    return email
+
+def fetch_emails(message_ids):
+    """Fetch emails in parallel, preserving the order of message_ids"""
+    emails = {}
+    for mid in message_ids:
+        cached = load_email(mid)
+        if cached is not None:
+            emails[mid] = cached
+    missing = [mid for mid in message_ids if mid not in emails]
+    log(f"Fetching {len(missing)} emails ({len(emails)} already parsed)", "SEARCH")
+    
+    if missing:
+        # googleapiclient services are not thread-safe, so each worker builds its own
+        worker_count = min(FETCH_WORKERS, len(missing))
+        chunks = [missing[i::worker_count] for i in range(worker_count)]
         
-        return email_contents
+        def fetch_chunk(chunk):
+            with span('gmail.service'):
+                service = get_gmail_service()
+            if not service:
+                return []
+            fetched = []
+            for message_id in chunk:
+                try:
+                    fetched.append(fetch_email(service, message_id, debug=message_id == missing[0]))
+                except Exception as e:
+                    log(f"Error fetching email {message_id}: {e}", "ERROR")
+            return fetched
         
-    except Exception as e:
-        log(f"Error searching emails: {e}", "ERROR")
+        with span('fetch', count=len(missing), workers=worker_count), \
+                ThreadPoolExecutor(max_workers=worker_count) as executor:
+            for fetched in executor.map(propagate(fetch_chunk), chunks):
+                for email in fetched:
+                    emails[email['message_id']] = email
+    
+    return [emails[mid] for mid in message_ids if mid in emails]
+
+def tokenize(text):
+    """Lowercase word tokens with stop words removed"""
+    return [word for word in re.findall(r'[a-z0-9]+', text.lower())
+            if word not in STOP_WORDS and len(word) > 2]
+
+def relax_gmail_query(natural_query):
+    """Build a broad Gmail query that matches any keyword of the question"""
+    keywords = extract_keywords(natural_query, limit=6)
+    if not keywords:
+        return 'in:inbox'
+    # Gmail treats {a b c} as "a OR b OR c"
+    return 'in:inbox {' + keywords + '}'
+
+def _unindex_email(message_id):
+    """Remove an email from the term index; caller holds INDEX_LOCK"""
+    _, weights = INDEXED_EMAILS.pop(message_id, (None, {}))
+    for term in weights:
+        postings = TERM_INDEX.get(term)
+        if postings is not None:
+            postings.pop(message_id, None)
+            if not postings:
+                del TERM_INDEX[term]
+
+def index_email(email, refresh=False):
+    """Add an email to this worker's term index, dropping the least recently seen past LOCAL_INDEX_SIZE"""
+    message_id = email['message_id']
+    with INDEX_LOCK:
+        if message_id in INDEXED_EMAILS and not refresh:
+            INDEXED_EMAILS.move_to_end(message_id)
+            return
+    
+    # Subject matches count most, then sender, then body
+    weights = {}
+    for field, weight in (('subject', 3), ('sender', 2), ('body', 1)):
+        for term in set(tokenize(email[field])):
+            weights[term] = weights.get(term, 0) + weight
+    
+    with INDEX_LOCK:
+        _unindex_email(message_id)
+        INDEXED_EMAILS[message_id] = (email['internal_date'], weights)
+        for term, weight in weights.items():
+            TERM_INDEX.setdefault(term, {})[message_id] = weight
+        while len(INDEXED_EMAILS) > LOCAL_INDEX_SIZE:
+            _unindex_email(next(iter(INDEXED_EMAILS)))
+
+def rank_local_emails(natural_query, max_results=10):
+    """Rank emails this worker has already seen by keyword overlap with the question"""
+    query_terms = set(tokenize(natural_query))
+    if not query_terms:
         return []
     
+    scores = {}
+    with INDEX_LOCK:
+        for term in query_terms:
+            for message_id, weight in TERM_INDEX.get(term, {}).items():
+                scores[message_id] = scores.get(message_id, 0) + weight
+        scored = sorted(((score, INDEXED_EMAILS[message_id][0], message_id)
+                         for message_id, score in scores.items()), reverse=True)
+        indexed_count = len(INDEXED_EMAILS)
+    
+    log(f"Local ranking matched {len(scored)} of {indexed_count} indexed emails", "SEARCH")
+    return [message_id for _, _, message_id in scored[:max_results]]
+
+def reciprocal_rank_fusion(ranked_lists, k=RRF_K):
+    """Merge several ranked id lists into one, best first"""
+    scores = {}
+    for ranked_ids in ranked_lists:
+        for rank, message_id in enumerate(ranked_ids):
+            scores[message_id] = scores.get(message_id, 0) + 1 / (k + rank + 1)
+    return sorted(scores, key=scores.get, reverse=True)
+
+def plan_retrieval(natural_query, max_results=10, deadline=PLANNER_DEADLINE):
+    """Run all candidate generators in parallel and fuse whatever arrives before the deadline
+    
+    Returns (emails, plan) or (None, plan) when Gmail is not reachable. An empty
+    list with plan['gmail_answered'] False means Gmail timed out or failed.
+    """
+    start_time = time.time()
+    relaxed_query = relax_gmail_query(natural_query)
+    translated = {}
+    
+    def translated_candidates():
+        with span('translate'):
+            translated['query'] = natural_language_to_gmail_query(natural_query)
+        log(f"Translated Gmail query: '{translated['query']}'", "QUERY")
+        return list_message_ids(translated['query'], max_results)
+    
+    generators = {
+        'translated': translated_candidates,
+        'relaxed': lambda: list_message_ids(relaxed_query, max_results),
+        'local': lambda: rank_local_emails(natural_query, max_results),
+    }
+    
+    executor = ThreadPoolExecutor(max_workers=len(generators))
+    def run_generator(name, generator):
+        with span(f'candidates.{name}'):
+            return generator()
+    
+    futures = {executor.submit(propagate(run_generator), name, generator): name
+               for name, generator in generators.items()}
+    done, pending = wait(futures, timeout=deadline)
+    # Don't let a slow source hold up the response; it finishes in the background
+    executor.shutdown(wait=False, cancel_futures=True)
+    
+    ranked_lists = {}
+    unavailable = []
+    for future in done:
+        name = futures[future]
+        try:
+            message_ids = future.result()
+        except Exception as e:
+            log(f"Candidate generator '{name}' failed: {e}", "ERROR")
+            continue
+        if message_ids is None:
+            unavailable.append(name)
+            continue
+        ranked_lists[name] = message_ids
+    
+    plan = {
+        'gmail_query': translated.get('query', relaxed_query),
+        'relaxed_query': relaxed_query,
+        'candidates': {name: len(ids) for name, ids in ranked_lists.items()},
+        'timed_out': sorted(futures[future] for future in pending),
+        'deadline': deadline,
+        # False when neither Gmail source answered, so an empty result says nothing about the mailbox
+        'gmail_answered': 'translated' in ranked_lists or 'relaxed' in ranked_lists,
+    }
+    log(f"Retrieval plan after {time.time() - start_time:.2f}s: {plan['candidates']} "
+        f"(timed out: {plan['timed_out'] or 'none'})", "SEARCH")
+    
+    if 'translated' in unavailable and 'relaxed' in unavailable:
+        return None, plan
+    
+    fused_ids = reciprocal_rank_fusion(ranked_lists.values())[:max_results]
+    return fetch_emails(fused_ids), plan
+    
 def extract_email_body(payload):
     """Extract email body text from payload - fixed version"""
     body = ""
@@ -303,13 +586,13 @@ def extract_email_body(payload):
         else:
             log("No body content extracted", "EMAIL")
             # Fallback to snippet if no body found
-            body = "No readable content extracted from email."
+            body = NO_CONTENT_BODY
         
         return body
         
     except Exception as e:
         log(f"Error in extract_email_body: {e}", "ERROR")
-        return "Error extracting email content."
+        return EXTRACTION_ERROR_BODY
 
 def extract_attachment_info(payload):
     """Detect and list attachments in email"""
@@ -332,12 +615,12 @@ def extract_attachment_info(payload):
         log(f"Error extracting attachment info: {e}", "ERROR")
         return []
 
-def query_deepseek(prompt, context):
-    """Query DeepSeek API with context"""
+def query_deepseek(prompt, context, history=None):
+    """Query DeepSeek API with context; returns None if DeepSeek couldn't answer"""
     api_key = os.getenv('DEEPSEEK_API_KEY')
     if not api_key or api_key == 'your_actual_deepseek_api_key_here':
-        log("DeepSeek API key not configured", "ERROR")
-        return "Error: Please set up your DeepSeek API key in the .env file"
+        log("DeepSeek API key not configured - set DEEPSEEK_API_KEY in the .env file", "ERROR")
+        return None
     
     headers = {
         'Authorization': f'Bearer {api_key}',
@@ -376,103 +659,188 @@ Format your response like this:
 
 **Important:** If the AI returns poorly formatted text, enforce clean formatting in your fallback function."""
 
-    full_prompt = f"""I found these emails related to your query. Please analyze them and provide a helpful response.
+    def question_message(question):
+        return {"role": "user", "content": f"""USER'S QUESTION: {question}
 
-USER'S QUESTION: {prompt}
+Please provide a well-structured, easy-to-read answer:"""}
+    
+    # System message and email context come first and never change within a
+    # conversation, so follow-ups only append and DeepSeek's prefix cache can
+    # skip re-reading the emails. Earlier questions must be rebuilt byte for byte.
+    messages = [
+        {"role": "system", "content": system_message},
+        {"role": "user", "content": f"""I found these emails related to your query. Please analyze them and provide a helpful response.
 
 EMAILS FOUND:
-{context}
-
-Please provide a well-structured, easy-to-read answer:"""
+{context}"""}
+    ]
+    for previous_question, previous_answer in history or []:
+        messages.append(question_message(previous_question))
+        messages.append({"role": "assistant", "content": previous_answer})
+    messages.append(question_message(prompt))
     
     payload = {
         "model": "deepseek-chat",
-        "messages": [
-            {"role": "system", "content": system_message},
-            {"role": "user", "content": full_prompt}
-        ],
+        "messages": messages,
         "temperature": 0.7,
         "max_tokens": 1500
     }
     
+    answer_key = hashlib.sha256(json.dumps(messages).encode('utf-8')).hexdigest()
+    cached = CACHE.get('answers', answer_key)
+    if cached:
+        log("Using cached DeepSeek answer for identical prompt", "AI")
+        return cached
+    
     try:
         log("Sending request to DeepSeek API...", "AI")
         start_time = time.time()
         
-        response = requests.post(
-            'https://api.deepseek.com/v1/chat/completions',
-            headers=headers,
-            json=payload,
-            timeout=200
-        )
+        with span('deepseek', messages=len(messages)):
+            response = requests.post(
+                'https://api.deepseek.com/v1/chat/completions',
+                headers=headers,
+                json=payload,
+                timeout=DEEPSEEK_TIMEOUT
+            )
         
         ai_time = time.time() - start_time
         
         if response.status_code == 200:
             log(f"DeepSeek API response received in {ai_time:.2f}s", "AI")
-            return response.json()['choices'][0]['message']['content']
+            result = response.json()
+            usage = result.get('usage', {})
+            if 'prompt_cache_hit_tokens' in usage:
+                log(f"Prompt cache: {usage['prompt_cache_hit_tokens']} hit / {usage.get('prompt_cache_miss_tokens', 0)} miss tokens", "AI")
+            answer = result['choices'][0]['message']['content']
+            CACHE.set('answers', answer_key, answer, ttl=ANSWER_TTL)
+            return answer
         else:
             log(f"DeepSeek API error: {response.status_code} - {response.text}", "ERROR")
-            return create_formatted_fallback_response(prompt, context)
+            return None
     
     except Exception as e:
         log(f"Error calling DeepSeek API: {str(e)}", "ERROR")
-        return create_formatted_fallback_response(prompt, context)
+        return None
 
-def create_formatted_fallback_response(query, context):
-    """Create a nicely formatted response when DeepSeek API fails"""
-    log("Using fallback response (DeepSeek API unavailable)", "AI")
-    if not context:
-        return "## 📊 Summary\nI searched your emails but didn't find any messages matching your query."
+def split_sentences(text):
+    """Split an email body into reasonably sized sentences"""
+    sentences = re.split(r'(?<=[.!?])\s+|\n+', text)
+    return [s.strip() for s in sentences if 20 <= len(s.strip()) <= 400]
+
+def rank_sentences(query, emails):
+    """Score every body sentence by TF-IDF similarity to the question
     
-    # Count emails and extract subjects
-    email_count = context.count('Subject:')
-    lines = context.split('\n')
-    subjects = []
-    dates = []
-    senders = []
-    
-    current_subject = ""
-    current_date = ""
-    current_sender = ""
-    
-    for line in lines:
-        if line.startswith('Subject:'):
-            current_subject = line.replace('Subject:', '').strip()
-        elif line.startswith('Date:'):
-            current_date = line.replace('Date:', '').strip()
-        elif line.startswith('From:'):
-            current_sender = line.replace('From:', '').strip()
-            # When we hit a new sender, we've completed one email
-            if current_subject and current_subject != 'No Subject':
-                subjects.append(current_subject)
-                dates.append(current_date)
-                senders.append(current_sender)
-    
-    if email_count == 0:
-        return "## 📊 Summary\nNo relevant emails found for your search."
-    
-    # Create formatted response
-    response = f"""## 📊 Summary
-I found {email_count} email(s) related to your question.
+    Returns a list of (score, sentence, email), best first.
+    """
+    candidates = [(sentence, email) for email in emails
+                  if email.get('body') not in (NO_CONTENT_BODY, EXTRACTION_ERROR_BODY)
+                  for sentence in split_sentences(email.get('body', ''))]
+    if not candidates:
+        return []
+    
+    sentence_terms = [tokenize(sentence) for sentence, _ in candidates]
+    document_frequency = {}
+    for terms in sentence_terms:
+        for term in set(terms):
+            document_frequency[term] = document_frequency.get(term, 0) + 1
+    
+    query_terms = set(tokenize(query))
+    total = len(candidates)
+    ranked = []
+    for (sentence, email), terms in zip(candidates, sentence_terms):
+        if not terms:
+            continue
+        score = sum(terms.count(term) / len(terms) * math.log(1 + total / document_frequency[term])
+                    for term in query_terms if term in document_frequency)
+        # Sentences from emails whose subject matches the question are usually the relevant ones
+        if query_terms & set(tokenize(email.get('subject', ''))):
+            score *= 1.5
+        ranked.append((score, sentence, email))
+    
+    ranked.sort(key=lambda item: item[0], reverse=True)
+    return ranked
 
-## 🔍 Key Findings
-- Found emails from various senders including job platforms and professional networks
-- Dates range from recent to older messages
-- Content includes job opportunities and professional updates
+def format_internal_date(internal_date):
+    """Format Gmail's internalDate (ms since epoch) for display"""
+    if not internal_date:
+        return 'Unknown date'
+    return datetime.datetime.fromtimestamp(internal_date / 1000).strftime('%b %d, %Y')
 
-## 📧 Email Highlights"""
+def create_formatted_fallback_response(query, emails):
+    """Build an extractive markdown answer from the email records, without the LLM"""
+    log("Using local extractive response (DeepSeek API unavailable or too slow)", "AI")
+    if not emails:
+        return "## 📊 Summary\nI searched your emails but didn't find any messages matching your query."
+    
+    with span('extractive.rank', emails=len(emails)):
+        ranked = rank_sentences(query, emails)
     
-    for i, (subject, date, sender) in enumerate(zip(subjects[:5], dates[:5], senders[:5])):
-        response += f"\n- **{subject}** ({format_date_display(date)}) - From: {sender}"
+    # Best sentence per email, used both for findings and to order the highlights
+    best_sentence = {}
+    for score, sentence, email in ranked:
+        best_sentence.setdefault(email['message_id'], (score, sentence))
     
-    if email_count > 5:
-        response += f"\n- ... and {email_count - 5} more emails"
+    senders = {email['sender'] for email in emails}
+    dates = [email['internal_date'] for email in emails if email.get('internal_date')]
+    
+    response = f"""## 📊 Summary
+I found {len(emails)} email(s) from {len(senders)} sender(s) related to your question"""
+    if dates:
+        response += f", dated {format_internal_date(min(dates))} to {format_internal_date(max(dates))}"
+    response += ".\n\n## 🔍 Key Findings"
+    
+    # When no sentence matches the question, the first one is still quoted as a starting point
+    findings = []
+    for score, sentence, email in ranked:
+        if len(findings) == 5 or (score <= 0 and findings):
+            break
+        if sentence not in [f for f, _ in findings]:
+            findings.append((sentence, email))
+    if findings:
+        for sentence, email in findings:
+            response += f"\n- {sentence} (**{email['subject']}**)"
+    else:
+        response += "\n- The matching emails have no readable text to quote from"
+    
+    response += "\n\n## 📧 Email Highlights"
+    highlights = sorted(emails, key=lambda email: best_sentence.get(email['message_id'], (0, ''))[0], reverse=True)
+    for email in highlights[:5]:
+        response += f"\n- **{email['subject']}** ({format_date_display(email['date'])}) - From: {email['sender']}"
+    
+    if len(emails) > 5:
+        response += f"\n- ... and {len(emails) - 5} more emails"
     
     response += "\n\n## 💡 Next Steps\nYou can click on any email below to open it in Gmail for more details."
     
     return response
 
+def answer_with_deadline(query, context, emails, deadline=ANSWER_DEADLINE, history=None):
+    """Race DeepSeek against the local extractive answer; returns (answer, mode)"""
+    if deadline <= 0:
+        return create_formatted_fallback_response(query, emails), 'extractive'
+    
+    executor = ThreadPoolExecutor(max_workers=1)
+    future = executor.submit(propagate(query_deepseek), query, context, history)
+    executor.shutdown(wait=False)
+    
+    try:
+        answer = future.result(timeout=deadline)
+    except FutureTimeoutError:
+        log(f"DeepSeek did not answer within {deadline:.1f}s, answering locally", "AI")
+        return create_formatted_fallback_response(query, emails), 'extractive'
+    
+    if answer is None:
+        return create_formatted_fallback_response(query, emails), 'extractive'
+    return answer, 'deepseek'
+
+def build_context(emails):
+    """Flatten email records into the context block sent to the LLM"""
+    return "\n".join([
+        f"Subject: {email['subject']}\nDate: {email['date']}\nFrom: {email['sender']}\nContent: {email['body']}\n"
+        for email in emails
+    ])
+
 def format_date_display(date_string):
     """Format date for display in responses"""
     if not date_string or date_string == 'Unknown Date':
@@ -486,6 +854,12 @@ def format_date_display(date_string):
 
 def natural_language_to_gmail_query(natural_query):
     """Use AI to convert natural language to Gmail search syntax"""
+    cache_key = ' '.join(natural_query.lower().split())
+    cached = CACHE.get('translations', cache_key)
+    if cached:
+        log(f"Using cached translation for '{natural_query}'", "QUERY")
+        return cached
+    
     api_key = os.getenv('DEEPSEEK_API_KEY')
     
     system_prompt = """You are a Gmail search query expert. Convert the user's natural language question into a valid Gmail search query.
@@ -540,6 +914,7 @@ Now convert this:"""
             query = response.json()['choices'][0]['message']['content'].strip()
             # Clean up any extra text
             query = query.replace('"', '').strip()
+            CACHE.set('translations', cache_key, query, ttl=TRANSLATION_TTL)
             return query
         else:
             # Fallback: simple keyword extraction
@@ -549,13 +924,103 @@ Now convert this:"""
         log(f"Query translation failed: {e}", "ERROR")
         return f"in:inbox {extract_keywords(natural_query)}"
 
-def extract_keywords(query):
+def extract_keywords(query, limit=3):
     """Simple keyword extraction fallback"""
-    # Remove question words and common phrases
-    stop_words = ['what', 'where', 'when', 'why', 'how', 'show', 'me', 'find', 'emails', 'email']
-    words = query.lower().split()
-    keywords = [word for word in words if word not in stop_words and len(word) > 2]
-    return ' '.join(keywords[:3])  # Use first 3 keywords
+    return ' '.join(tokenize(query)[:limit])  # Use first few keywords
+
+def get_conversation(conversation_id):
+    """Return a live conversation, or None if it is unknown or expired"""
+    return CACHE.get('conversations', conversation_id)
+
+def record_turn(conversation_id, question, answer, retrieval_turn=None, retrieval=None):
+    """Atomically append a turn to a conversation and return its turn number
+    
+    Pass retrieval ({'message_ids', 'gmail_query'}) for a turn that searched
+    again, or the retrieval_turn whose emails a follow-up reused. Emails are
+    stored as message ids and resolved through the shared email cache.
+    """
+    recorded = {}
+    
+    def append(conversation):
+        conversation = conversation or {'next_turn': 0, 'turns': [], 'retrievals': []}
+        number = conversation['next_turn']
+        conversation['next_turn'] += 1
+        
+        used_retrieval = retrieval_turn
+        if retrieval is not None:
+            used_retrieval = number
+            conversation['retrievals'] = (conversation['retrievals']
+                                          + [dict(retrieval, turn=number)])[-MAX_STORED_RETRIEVALS:]
+        conversation['turns'] = (conversation['turns'] + [{
+            'turn': number,
+            'question': question,
+            'answer': answer,
+            'retrieval_turn': used_retrieval
+        }])[-MAX_STORED_TURNS:]
+        
+        recorded['turn'] = number
+        return conversation
+    
+    # Every append restarts the conversation's TTL
+    CACHE.update('conversations', conversation_id, append, ttl=CONVERSATION_TTL)
+    return recorded['turn']
+
+def find_retrieval(conversation, turn_number=None):
+    """The retrieved email set a turn used, or the latest one if that turn is unknown or dropped"""
+    retrievals = {retrieval['turn']: retrieval for retrieval in conversation['retrievals']}
+    try:
+        turn_number = int(turn_number)
+    except (ValueError, TypeError):
+        return conversation['retrievals'][-1]
+    
+    for turn in conversation['turns']:
+        if turn['turn'] == turn_number and turn['retrieval_turn'] in retrievals:
+            return retrievals[turn['retrieval_turn']]
+    return retrievals.get(turn_number, conversation['retrievals'][-1])
+
+def conversation_history(conversation, retrieval_turn):
+    """Previous questions and answers asked over the same retrieved emails"""
+    history = [(turn['question'], turn['answer']) for turn in conversation['turns']
+               if turn['retrieval_turn'] == retrieval_turn]
+    return history[-MAX_HISTORY_TURNS:]
+
+def debug_flag(name):
+    """True if a debug option was requested via X-Debug-<Name> header or ?<name>=1"""
+    value = request.headers.get(f'X-Debug-{name}', request.args.get(name.lower(), ''))
+    return value.lower() in ('1', 'true', 'yes')
+
+@app.before_request
+def start_request_trace():
+    """Trace every API request; the sampled CPU profile is opt-in"""
+    if not request.path.startswith('/api/') or request.path.startswith('/api/debug/'):
+        return
+    profile = debug_flag('Profile')
+    g.trace = Trace(f"{request.method} {request.path}", profile=profile)
+    g.trace_requested = profile or debug_flag('Trace')
+
+@app.after_request
+def finish_request_trace(response):
+    """Keep requested traces and, automatically, the slow ones"""
+    trace = g.get('trace')
+    if trace is None:
+        return response
+    
+    trace.finish()
+    if g.trace_requested:
+        CACHE.set('traces', trace.trace_id, trace.to_dict(), ttl=TRACE_TTL)
+        response.headers['X-Trace-Id'] = trace.trace_id
+    if trace.duration >= SLOW_TRACE_SECONDS:
+        log(f"Slow request {trace.root.name} took {trace.duration:.2f}s, trace {trace.trace_id} kept", "TRACE")
+        CACHE.set('slow_traces', trace.trace_id, trace.to_dict())
+        CACHE.trim('slow_traces', SLOW_TRACE_LIMIT)
+    return response
+
+@app.teardown_request
+def close_request_trace(error):
+    """Finish the trace even when the view raised and after_request never ran"""
+    trace = g.pop('trace', None)
+    if trace is not None:
+        trace.finish()
 
 @app.route('/api/query', methods=['POST'])
 def handle_query():
@@ -583,22 +1048,49 @@ def handle_query():
         except (ValueError, TypeError):
             max_results = 10
         
+        # Seconds to wait for DeepSeek before answering locally; 0 skips the LLM
+        try:
+            answer_deadline = float(data.get('answer_deadline', ANSWER_DEADLINE))
+        except (ValueError, TypeError):
+            answer_deadline = ANSWER_DEADLINE
+        if not math.isfinite(answer_deadline):
+            log("Query rejected - answer_deadline is not a finite number", "QUERY")
+            return jsonify({'error': 'answer_deadline must be a finite number of seconds'}), 400
+        answer_deadline = max(0.0, min(DEEPSEEK_TIMEOUT, answer_deadline))
+        
         log(f"Natural language query: '{natural_query}'", "QUERY")
         
         if not natural_query:
             log("Query rejected - empty query", "QUERY")
             return jsonify({'error': 'No query provided'}), 400
         
-        # Step 1: Translate natural language to Gmail query
-        log("Step 1: Translating natural language to Gmail query...", "QUERY")
-        gmail_query = natural_language_to_gmail_query(natural_query)
-        log(f"Translated Gmail query: '{gmail_query}'", "QUERY")
+        # Follow-ups reuse a previous turn's emails instead of searching again
+        conversation_id = data.get('conversation_id')
+        conversation = get_conversation(conversation_id) if conversation_id else None
+        if conversation_id and conversation is None:
+            log(f"Unknown conversation {conversation_id}, starting a new one", "QUERY")
+        if conversation is None:
+            conversation_id = uuid.uuid4().hex
+        
+        follow_up = bool(data.get('follow_up', True)) and bool(conversation and conversation['retrievals'])
+        retrieval_turn = None
         
-        # Step 2: Search emails using translated query
-        log("Step 2: Searching emails...", "QUERY")
-        email_results = search_emails(gmail_query, max_results)
+        if follow_up:
+            retrieval = find_retrieval(conversation, data.get('follow_up_turn'))
+            retrieval_turn = retrieval['turn']
+            log(f"Step 1: Follow-up - reusing emails retrieved in turn {retrieval_turn}", "QUERY")
+            # Normally all cache hits; only emails evicted since that turn are fetched again
+            email_results = fetch_emails(retrieval['message_ids'])
+            gmail_query = retrieval['gmail_query']
+            retrieval_plan = {'reused_turn': retrieval_turn}
+        else:
+            # Step 1: Run the translated, relaxed and local candidate generators under a deadline
+            log("Step 1: Planning retrieval (translated + relaxed + local)...", "QUERY")
+            with span('plan_retrieval'):
+                email_results, retrieval_plan = plan_retrieval(natural_query, max_results)
+            gmail_query = retrieval_plan['gmail_query']
         
-        # Check if search_emails returned None (not authenticated)
+        # Check if plan_retrieval returned None (not authenticated)
         if email_results is None:
             log("Search failed - authentication issue", "QUERY")
             return jsonify({
@@ -606,6 +1098,14 @@ def handle_query():
                 'requires_auth': True
             }), 401
         
+        if not email_results and not retrieval_plan.get('gmail_answered', True):
+            log(f"Gmail did not answer before the retrieval deadline (timed out: {retrieval_plan['timed_out'] or 'none'})", "QUERY")
+            return jsonify({
+                'error': f"Your mailbox could not be searched within {retrieval_plan['deadline']:.1f}s "
+                         f"because Gmail was slow or unavailable. Please try again.",
+                'retrieval_plan': retrieval_plan
+            }), 504
+        
         if not email_results:
             log("No emails found for query", "QUERY")
             return jsonify({
@@ -614,18 +1114,29 @@ def handle_query():
                 'translated_query': gmail_query  # Show user what was searched
             })
         
-        # Step 3: Prepare context from emails
-        log(f"Step 3: Preparing context from {len(email_results)} emails...", "QUERY")
-        context = "\n".join([
-            f"Subject: {email['subject']}\nDate: {email['date']}\nFrom: {email['sender']}\nContent: {email['body']}\n"
-            for email in email_results
-        ])
+        # Step 2: Prepare context from emails
+        log(f"Step 2: Preparing context from {len(email_results)} emails...", "QUERY")
+        with span('build_context'):
+            context = build_context(email_results)
         
         log(f"Context prepared: {len(context)} characters", "QUERY")
         
-        # Step 4: Query DeepSeek with context
-        log("Step 4: Sending to DeepSeek AI...", "QUERY")
-        answer = query_deepseek(natural_query, context)  # Use original natural query
+        # Step 3: Query DeepSeek with context, falling back to a local answer at the deadline
+        log(f"Step 3: Sending to DeepSeek AI (deadline {answer_deadline:.1f}s)...", "QUERY")
+        history = conversation_history(conversation, retrieval_turn) if follow_up else []
+        with span('answer', deadline=answer_deadline) as answer_span:
+            answer, answer_mode = answer_with_deadline(natural_query, context, email_results, answer_deadline,
+                                                       history=history)  # Use original natural query
+        if answer_span:
+            answer_span.attrs['mode'] = answer_mode
+        
+        if follow_up:
+            turn = record_turn(conversation_id, natural_query, answer, retrieval_turn=retrieval_turn)
+        else:
+            turn = record_turn(conversation_id, natural_query, answer, retrieval={
+                'message_ids': [email['message_id'] for email in email_results],
+                'gmail_query': gmail_query
+            })
         
         total_time = time.time() - start_time
         log(f"=== QUERY COMPLETED in {total_time:.2f}s ===", "QUERY")
@@ -634,11 +1145,16 @@ def handle_query():
         return jsonify({
             'answer': answer,
             'sources': email_results,
+            'conversation_id': conversation_id,
             'search_metadata': {
                 'original_query': natural_query,
                 'gmail_query_used': gmail_query,
                 'max_results_requested': max_results,
                 'emails_found': len(email_results),
+                'retrieval_plan': retrieval_plan,
+                'answer_mode': answer_mode,
+                'follow_up': follow_up,
+                'turn': turn,
                 'processing_time': f"{total_time:.2f}s"
             }
         })
@@ -650,7 +1166,6 @@ def handle_query():
 @app.route('/api/auth/gmail', methods=['GET'])
 def gmail_auth():
     """Initialize Gmail authentication"""
-    global AUTHENTICATED
     
     try:
         log("Starting Gmail authentication flow...", "AUTH")
@@ -658,10 +1173,9 @@ def gmail_auth():
             'credentials.json', SCOPES)
         creds = flow.run_local_server(port=0)
         
-        with open('token.json', 'w') as token:
-            token.write(creds.to_json())
+        save_token(creds)
         
-        AUTHENTICATED = True
+        set_authenticated(True)
         
         service = build('gmail', 'v1', credentials=creds)
         profile = service.users().getProfile(userId='me').execute()
@@ -673,14 +1187,13 @@ def gmail_auth():
         })
             
     except Exception as e:
-        AUTHENTICATED = False
+        set_authenticated(False)
         log(f"Authentication failed: {e}", "ERROR")
         return jsonify({'error': str(e)}), 500
 
 @app.route('/api/auth/status', methods=['GET'])
 def auth_status():
     """Check authentication status"""
-    global AUTHENTICATED
     
     log("Checking authentication status...", "AUTH")
     try:
@@ -693,20 +1206,19 @@ def auth_status():
                     'email': profile.get('emailAddress', 'Unknown')
                 })
         
-        AUTHENTICATED = False
+        set_authenticated(False)
         return jsonify({'authenticated': False})
     except:
-        AUTHENTICATED = False
+        set_authenticated(False)
         return jsonify({'authenticated': False})
 
 @app.route('/api/auth/logout', methods=['POST'])
 def logout():
     """Remove authentication completely"""
-    global AUTHENTICATED
     
     log("User logging out...", "AUTH")
     try:
-        AUTHENTICATED = False
+        set_authenticated(False)
         
         token_path = 'token.json'
         if os.path.exists(token_path):
@@ -772,13 +1284,105 @@ def debug_test():
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
+@app.route('/api/debug/trace/<trace_id>', methods=['GET'])
+def debug_trace(trace_id):
+    """Span tree (and profile, if one was taken) of a traced request"""
+    trace = CACHE.get('traces', trace_id) or CACHE.get('slow_traces', trace_id)
+    if not trace:
+        return jsonify({'error': 'Trace not found or expired'}), 404
+    return jsonify(trace)
+
+@app.route('/api/debug/traces/slow', methods=['GET'])
+def debug_slow_traces():
+    """Most recent requests that exceeded SLOW_TRACE_SECONDS"""
+    return jsonify({
+        'threshold_seconds': SLOW_TRACE_SECONDS,
+        'traces': [{
+            'trace_id': trace['trace_id'],
+            'name': trace['root']['name'],
+            'started_at': trace['started_at'],
+            'duration_ms': trace['duration_ms']
+        } for trace in CACHE.values('slow_traces')]
+    })
+
+def mute_extraction_logs():
+    """Keep per-message logging out of reindex output"""
+    MUTED_LOG_TYPES.update({'EMAIL', 'DEBUG', 'SEARCH'})
+
+def reprocess_batch(message_ids):
+    """Rebuild the stale parsed records of one batch; runs in a worker process"""
+    counts = {'rebuilt': 0, 'fresh': 0, 'missing': 0, 'failed': 0}
+    for message_id in message_ids:
+        raw = CACHE.get('raw_messages', message_id)
+        if raw is None:
+            counts['missing'] += 1
+            continue
+        if not is_stale(CACHE.get('emails', message_id), raw):
+            counts['fresh'] += 1
+            continue
+        try:
+            CACHE.set('emails', message_id, parse_gmail_message(raw))
+            counts['rebuilt'] += 1
+        except Exception as e:
+            log(f"Error reprocessing {message_id}: {e}", "ERROR")
+            counts['failed'] += 1
+    return counts
+
+@app.cli.command('reindex')
+@click.option('--batch-size', default=200, show_default=True, help='Messages per batch.')
+@click.option('--workers', default=os.cpu_count(), show_default=True, help='Worker processes.')
+@click.option('--restart', is_flag=True, help='Ignore the saved checkpoint and start over.')
+def reindex_command(batch_size, workers, restart):
+    """Re-extract stored messages whose extractor version or content changed"""
+    if isinstance(CACHE, MemoryCache):
+        raise click.ClickException("reindex needs a shared cache backend (CACHE_BACKEND=sqlite)")
+    
+    message_ids = sorted(CACHE.keys('raw_messages'))
+    checkpoint = CACHE.get('reindex', 'checkpoint')
+    if restart or not checkpoint or checkpoint['extractor_version'] != EXTRACTOR_VERSION:
+        checkpoint = None
+    else:
+        message_ids = [mid for mid in message_ids if mid > checkpoint['done_through']]
+        log(f"Resuming after checkpoint {checkpoint['done_through']}", "REINDEX")
+    
+    batches = [message_ids[i:i + batch_size] for i in range(0, len(message_ids), batch_size)]
+    log(f"Reindexing {len(message_ids)} stored messages for extractor v{EXTRACTOR_VERSION} "
+        f"in {len(batches)} batches on {workers} workers", "REINDEX")
+    
+    totals = {'rebuilt': 0, 'fresh': 0, 'missing': 0, 'failed': 0}
+    start_time = time.time()
+    # Spawned rather than forked: a forked child would inherit this process's open SQLite connection
+    context = multiprocessing.get_context('spawn')
+    with ProcessPoolExecutor(max_workers=workers, mp_context=context, initializer=mute_extraction_logs) as executor:
+        # map() yields in submission order, so the checkpoint only ever covers finished batches
+        for index, (batch, counts) in enumerate(zip(batches, executor.map(reprocess_batch, batches)), 1):
+            for name, count in counts.items():
+                totals[name] += count
+            CACHE.set('reindex', 'checkpoint', {
+                'extractor_version': EXTRACTOR_VERSION,
+                'done_through': batch[-1]
+            })
+            
+            elapsed = time.time() - start_time
+            processed = sum(totals.values())
+            log(f"Batch {index}/{len(batches)}: {counts['rebuilt']} rebuilt, {counts['fresh']} fresh, "
+                f"{counts['missing']} missing, {counts['failed']} failed | {processed / elapsed:.0f} messages/s", "REINDEX")
+    
+    CACHE.delete('reindex', 'checkpoint')
+    elapsed = time.time() - start_time
+    log(f"Reindex finished in {elapsed:.2f}s: {totals['rebuilt']} rebuilt, {totals['fresh']} already fresh, "
+        f"{totals['missing']} missing, {totals['failed']} failed", "REINDEX")
+    if totals['missing']:
+        log(f"{totals['missing']} raw messages were evicted (CACHE_RAW_MAX_MB); "
+            f"they will be fetched from Gmail again when a query needs them", "REINDEX")
+
 @app.route('/')
 def home():
     log("Home page accessed", "SERVER")
     return jsonify({'message': 'RAG Gmail API is running!'})
 
 if __name__ == '__main__':
-    AUTHENTICATED = False
+    set_authenticated(False)
     log("=== RAG Gmail API Server Starting ===", "SERVER")
     log("Server running on http://127.0.0.1:5000", "SERVER")
     app.run(debug=True, port=5000)
\ No newline at end of file
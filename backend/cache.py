@@ -0,0 +1,329 @@
+import json
+import os
+import sqlite3
+import threading
+import time
+
+
+class CacheBackend:
+    """Namespaced key/value cache shared by every part of the app
+
+    Values must be JSON-serialisable. Callers get a copy, so after mutating a
+    value it has to be written back with set().
+
+    Namespaces are grouped into eviction pools. Most share max_bytes; a
+    namespace given its own entry in budgets is evicted only against that
+    budget, so bulky data can't push out the warm state. Pinned namespaces
+    hold small control state (login, checkpoints): they have no budget and
+    are never evicted, only expired.
+    """
+
+    def __init__(self, max_bytes, pinned=(), budgets=None):
+        self.max_bytes = max_bytes
+        self.pinned = frozenset(pinned)
+        self.budgets = dict(budgets or {})
+        self._separate = self.pinned | set(self.budgets)
+
+    def _in_pool(self, namespace, pool_namespace):
+        """True if namespace is evicted together with pool_namespace"""
+        if pool_namespace in self._separate:
+            return namespace == pool_namespace
+        return namespace not in self._separate
+
+    def _budget(self, namespace):
+        return self.budgets.get(namespace, self.max_bytes)
+
+    def get(self, namespace, key, default=None):
+        raise NotImplementedError
+
+    def set(self, namespace, key, value, ttl=None):
+        raise NotImplementedError
+
+    def delete(self, namespace, key):
+        raise NotImplementedError
+
+    def update(self, namespace, key, fn, ttl=None):
+        """Atomically replace a value with fn(current value, or None); returns the new value"""
+        raise NotImplementedError
+
+    def items(self, namespace):
+        """All live (key, value) pairs of a namespace, most recently written first"""
+        raise NotImplementedError
+
+    def trim(self, namespace, max_entries):
+        """Drop the oldest entries of a namespace beyond max_entries"""
+        raise NotImplementedError
+
+    def values(self, namespace):
+        return [value for _, value in self.items(namespace)]
+
+    def keys(self, namespace):
+        return [key for key, _ in self.items(namespace)]
+
+
+class MemoryCache(CacheBackend):
+    """Single-process cache, for development or a one-worker deployment"""
+
+    def __init__(self, max_bytes, pinned=(), budgets=None):
+        super().__init__(max_bytes, pinned, budgets)
+        self._entries = {}  # (namespace, key) -> [payload, size, expires_at, accessed_at, updated_at]
+        self._sizes = {}  # namespace -> bytes
+        self._lock = threading.Lock()
+
+    def get(self, namespace, key, default=None):
+        with self._lock:
+            entry = self._entries.get((namespace, key))
+            if entry is None:
+                return default
+            if entry[2] is not None and entry[2] < time.time():
+                self._remove((namespace, key))
+                return default
+            entry[3] = time.time()
+            payload = entry[0]
+        return json.loads(payload)
+
+    def set(self, namespace, key, value, ttl=None):
+        payload = json.dumps(value)
+        with self._lock:
+            self._store(namespace, key, payload, ttl)
+
+    def update(self, namespace, key, fn, ttl=None):
+        with self._lock:
+            entry = self._entries.get((namespace, key))
+            live = entry is not None and (entry[2] is None or entry[2] >= time.time())
+            value = fn(json.loads(entry[0]) if live else None)
+            self._store(namespace, key, json.dumps(value), ttl)
+        return value
+
+    def _store(self, namespace, key, payload, ttl):
+        now = time.time()
+        self._remove((namespace, key))
+        self._entries[(namespace, key)] = [payload, len(payload), now + ttl if ttl else None, now, now]
+        self._sizes[namespace] = self._sizes.get(namespace, 0) + len(payload)
+        if namespace not in self.pinned and self._pool_size(namespace) > self._budget(namespace):
+            self._evict(namespace)
+
+    def delete(self, namespace, key):
+        with self._lock:
+            self._remove((namespace, key))
+
+    def items(self, namespace):
+        now = time.time()
+        with self._lock:
+            live = [(entry[4], key, entry[0]) for (ns, key), entry in self._entries.items()
+                    if ns == namespace and (entry[2] is None or entry[2] >= now)]
+        live.sort(key=lambda item: item[0], reverse=True)
+        return [(key, json.loads(payload)) for _, key, payload in live]
+
+    def trim(self, namespace, max_entries):
+        with self._lock:
+            keys = sorted((entry[4], cache_key) for cache_key, entry in self._entries.items()
+                          if cache_key[0] == namespace)
+            for _, cache_key in keys[:max(0, len(keys) - max_entries)]:
+                self._remove(cache_key)
+
+    def _remove(self, cache_key):
+        entry = self._entries.pop(cache_key, None)
+        if entry is not None:
+            self._sizes[cache_key[0]] -= entry[1]
+
+    def _pool_size(self, namespace):
+        return sum(size for ns, size in self._sizes.items() if self._in_pool(ns, namespace))
+
+    def _evict(self, namespace):
+        # Expired entries first, then least recently used down to 90% of the pool's budget
+        now = time.time()
+        for cache_key in [k for k, entry in self._entries.items() if entry[2] is not None and entry[2] < now]:
+            self._remove(cache_key)
+        size = self._pool_size(namespace)
+        target = self._budget(namespace) * 0.9
+        for _, cache_key in sorted((entry[3], k) for k, entry in self._entries.items()
+                                   if self._in_pool(k[0], namespace)):
+            if size <= target:
+                break
+            size -= self._entries[cache_key][1]
+            self._remove(cache_key)
+
+
+class SQLiteCache(CacheBackend):
+    """Cache in a SQLite file, shared by every worker process on the machine
+
+    Each write is its own transaction, so readers in other workers never see
+    a half-written value, and eviction happens in the same transaction.
+    Triggers keep a running byte total per namespace, so checking the budget
+    doesn't scan the table while holding the write lock.
+    """
+
+    # Reads only refresh the LRU timestamp this often, to keep readers from taking write locks
+    TOUCH_INTERVAL = 10
+
+    def __init__(self, path, max_bytes, pinned=(), budgets=None):
+        super().__init__(max_bytes, pinned, budgets)
+        self.path = path
+        self._local = threading.local()
+        with self._write() as conn:
+            conn.execute("""CREATE TABLE IF NOT EXISTS entries (
+                namespace TEXT NOT NULL,
+                key TEXT NOT NULL,
+                value TEXT NOT NULL,
+                size INTEGER NOT NULL,
+                expires_at REAL,
+                accessed_at REAL NOT NULL,
+                updated_at REAL NOT NULL,
+                PRIMARY KEY (namespace, key)
+            )""")
+            conn.execute("CREATE INDEX IF NOT EXISTS entries_accessed ON entries (accessed_at)")
+            conn.execute("""CREATE TABLE IF NOT EXISTS namespace_sizes (
+                namespace TEXT PRIMARY KEY,
+                total INTEGER NOT NULL
+            )""")
+            conn.execute("""CREATE TRIGGER IF NOT EXISTS entries_insert AFTER INSERT ON entries BEGIN
+                INSERT INTO namespace_sizes (namespace, total) VALUES (NEW.namespace, NEW.size)
+                ON CONFLICT (namespace) DO UPDATE SET total = total + NEW.size;
+            END""")
+            conn.execute("""CREATE TRIGGER IF NOT EXISTS entries_update AFTER UPDATE OF size ON entries BEGIN
+                UPDATE namespace_sizes SET total = total - OLD.size + NEW.size WHERE namespace = NEW.namespace;
+            END""")
+            conn.execute("""CREATE TRIGGER IF NOT EXISTS entries_delete AFTER DELETE ON entries BEGIN
+                UPDATE namespace_sizes SET total = total - OLD.size WHERE namespace = OLD.namespace;
+            END""")
+
+    def _connection(self):
+        # Connections can't cross threads or forked workers, so keep one per thread per process
+        conn = getattr(self._local, 'conn', None)
+        if conn is None or self._local.pid != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    def _write(self):
+        return _Transaction(self._connection())
+
+    def get(self, namespace, key, default=None):
+        # Reads run in autocommit mode so they never wait on writers (WAL)
+        now = time.time()
+        conn = self._connection()
+        row = conn.execute(
+            "SELECT value, expires_at, accessed_at FROM entries WHERE namespace = ? AND key = ?",
+            (namespace, key)).fetchone()
+        if row is None:
+            return default
+        value, expires_at, accessed_at = row
+        if expires_at is not None and expires_at < now:
+            conn.execute("DELETE FROM entries WHERE namespace = ? AND key = ?", (namespace, key))
+            return default
+        if now - accessed_at > self.TOUCH_INTERVAL:
+            conn.execute("UPDATE entries SET accessed_at = ? WHERE namespace = ? AND key = ?",
+                         (now, namespace, key))
+        return json.loads(value)
+
+    def set(self, namespace, key, value, ttl=None):
+        payload = json.dumps(value)
+        with self._write() as conn:
+            self._store(conn, namespace, key, payload, ttl)
+
+    def update(self, namespace, key, fn, ttl=None):
+        # BEGIN IMMEDIATE holds the write lock from the read to the write, so no worker can interleave
+        with self._write() as conn:
+            row = conn.execute(
+                "SELECT value FROM entries WHERE namespace = ? AND key = ? AND (expires_at IS NULL OR expires_at >= ?)",
+                (namespace, key, time.time())).fetchone()
+            value = fn(json.loads(row[0]) if row else None)
+            self._store(conn, namespace, key, json.dumps(value), ttl)
+        return value
+
+    def _store(self, conn, namespace, key, payload, ttl):
+        now = time.time()
+        # An upsert rather than INSERT OR REPLACE, whose implicit delete skips the triggers
+        conn.execute(
+            "INSERT INTO entries VALUES (?, ?, ?, ?, ?, ?, ?) ON CONFLICT (namespace, key) DO UPDATE SET "
+            "value = excluded.value, size = excluded.size, expires_at = excluded.expires_at, "
+            "accessed_at = excluded.accessed_at, updated_at = excluded.updated_at",
+            (namespace, key, payload, len(payload), now + ttl if ttl else None, now, now))
+        if namespace in self.pinned:
+            return
+        pool, params = self._pool_filter(namespace)
+        total = conn.execute(f"SELECT COALESCE(SUM(total), 0) FROM namespace_sizes WHERE {pool}",
+                             params).fetchone()[0]
+        if total > self._budget(namespace):
+            self._evict(conn, namespace, total, now)
+
+    def delete(self, namespace, key):
+        with self._write() as conn:
+            conn.execute("DELETE FROM entries WHERE namespace = ? AND key = ?", (namespace, key))
+
+    def items(self, namespace):
+        conn = self._connection()
+        rows = conn.execute(
+            "SELECT key, value FROM entries WHERE namespace = ? AND (expires_at IS NULL OR expires_at >= ?) "
+            "ORDER BY updated_at DESC", (namespace, time.time())).fetchall()
+        return [(key, json.loads(value)) for key, value in rows]
+
+    def keys(self, namespace):
+        # Skips loading values, which matters for large namespaces like raw messages
+        rows = self._connection().execute(
+            "SELECT key FROM entries WHERE namespace = ? AND (expires_at IS NULL OR expires_at >= ?)",
+            (namespace, time.time())).fetchall()
+        return [key for key, in rows]
+
+    def trim(self, namespace, max_entries):
+        with self._write() as conn:
+            conn.execute(
+                "DELETE FROM entries WHERE namespace = ? AND key NOT IN "
+                "(SELECT key FROM entries WHERE namespace = ? ORDER BY updated_at DESC LIMIT ?)",
+                (namespace, namespace, max_entries))
+
+    def _pool_filter(self, namespace):
+        """SQL condition (and parameters) selecting the namespaces in namespace's eviction pool"""
+        if namespace in self._separate:
+            return "namespace = ?", (namespace,)
+        separate = tuple(self._separate)
+        return f"namespace NOT IN ({', '.join('?' * len(separate))})", separate
+
+    def _evict(self, conn, namespace, total, now):
+        # Expired entries first, then least recently used down to 90% of the pool's budget
+        pool, params = self._pool_filter(namespace)
+        freed = conn.execute(f"SELECT COALESCE(SUM(size), 0) FROM entries WHERE expires_at < ? AND {pool}",
+                             (now, *params)).fetchone()[0]
+        conn.execute("DELETE FROM entries WHERE expires_at < ?", (now,))
+        target = self._budget(namespace) * 0.9
+        victims = []
+        for victim_namespace, key, size in conn.execute(
+                f"SELECT namespace, key, size FROM entries WHERE {pool} ORDER BY accessed_at", params):
+            if total - freed <= target:
+                break
+            victims.append((victim_namespace, key))
+            freed += size
+        conn.executemany("DELETE FROM entries WHERE namespace = ? AND key = ?", victims)
+
+
+class _Transaction:
+    """Run a block inside BEGIN IMMEDIATE ... COMMIT, rolling back on error"""
+
+    def __init__(self, conn):
+        self.conn = conn
+
+    def __enter__(self):
+        self.conn.execute("BEGIN IMMEDIATE")
+        return self.conn
+
+    def __exit__(self, exc_type, exc, tb):
+        self.conn.execute("ROLLBACK" if exc_type else "COMMIT")
+        return False
+
+
+def create_cache(pinned=(), budgets=None):
+    """Build the cache backend selected by CACHE_BACKEND (sqlite or memory)
+
+    budgets maps a namespace to its own size budget in bytes.
+    """
+    backend = os.getenv('CACHE_BACKEND', 'sqlite').lower()
+    max_bytes = int(os.getenv('CACHE_MAX_MB', '256')) * 1024 * 1024
+    if backend == 'memory':
+        return MemoryCache(max_bytes, pinned, budgets)
+    if backend == 'sqlite':
+        return SQLiteCache(os.getenv('CACHE_PATH', 'cache.sqlite3'), max_bytes, pinned, budgets)
+    raise ValueError(f"Unknown CACHE_BACKEND '{backend}' (expected 'sqlite' or 'memory')")
@@ -0,0 +1,12 @@
+# Production serving: python -m gunicorn app:app (run from the backend directory)
+# Workers share warm state through the SQLite cache (CACHE_BACKEND=sqlite, the default).
+import multiprocessing
+import os
+
+bind = os.getenv('BIND', '127.0.0.1:5000')
+workers = int(os.getenv('WEB_CONCURRENCY', multiprocessing.cpu_count()))
+# Requests mostly wait on Gmail and DeepSeek, so a few threads per worker help
+threads = int(os.getenv('WORKER_THREADS', '4'))
+# Follow-ups and deadline fallbacks keep most requests short, but the OAuth flow can take a while
+timeout = 300
+accesslog = '-'
@@ -0,0 +1,148 @@
+import contextvars
+import os
+import sys
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+
+# Innermost open span of the current request; None when nothing is being traced
+_current_span = contextvars.ContextVar('current_span', default=None)
+
+
+class Span:
+    def __init__(self, trace, name, attrs):
+        self.trace = trace
+        self.name = name
+        self.attrs = attrs
+        self.start = time.perf_counter()
+        self.end = None
+        self.children = []
+
+    def to_dict(self):
+        return {
+            'name': self.name,
+            'start_ms': round((self.start - self.trace.root.start) * 1000, 2),
+            'duration_ms': round((self.end - self.start) * 1000, 2) if self.end else None,
+            # Copied under the trace lock: late work may still be setting attributes
+            'attrs': dict(self.attrs),
+            'children': [child.to_dict() for child in self.children],
+        }
+
+
+class Trace:
+    """Span tree of one request, optionally with a sampled CPU profile"""
+
+    def __init__(self, name, profile=False, **attrs):
+        self.trace_id = uuid.uuid4().hex
+        self.started_at = time.time()
+        self.thread_ids = {threading.get_ident()}
+        self.lock = threading.Lock()
+        self.root = Span(self, name, attrs)
+        self.profiler = SamplingProfiler(self) if profile else None
+        self._token = _current_span.set(self.root)
+        if self.profiler:
+            self.profiler.start()
+
+    @property
+    def duration(self):
+        return (self.root.end or time.perf_counter()) - self.root.start
+
+    def finish(self):
+        if self.root.end is not None:
+            return
+        self.root.end = time.perf_counter()
+        _current_span.reset(self._token)
+        if self.profiler:
+            self.profiler.stop()
+
+    def to_dict(self):
+        # Background work that outlived the deadline may still be adding spans
+        with self.lock:
+            result = {
+                'trace_id': self.trace_id,
+                'started_at': self.started_at,
+                'duration_ms': round(self.duration * 1000, 2),
+                'root': self.root.to_dict(),
+            }
+        if self.profiler:
+            result['profile'] = self.profiler.to_dict()
+        return result
+
+
+@contextmanager
+def span(name, **attrs):
+    """Record a child span of the current one; a no-op outside a trace"""
+    parent = _current_span.get()
+    if parent is None:
+        yield None
+        return
+
+    trace = parent.trace
+    child = Span(trace, name, attrs)
+    with trace.lock:
+        parent.children.append(child)
+        trace.thread_ids.add(threading.get_ident())
+    token = _current_span.set(child)
+    try:
+        yield child
+    except Exception as e:
+        child.attrs['error'] = str(e)
+        raise
+    finally:
+        child.end = time.perf_counter()
+        _current_span.reset(token)
+
+
+def propagate(fn):
+    """Wrap fn so it runs under the caller's trace when handed to a thread pool"""
+    context = contextvars.copy_context()
+
+    def run(*args, **kwargs):
+        # A Context can only be entered by one thread at a time, so each call gets a copy
+        return context.copy().run(fn, *args, **kwargs)
+    return run
+
+
+class SamplingProfiler(threading.Thread):
+    """Periodically samples the stacks of the threads working on one trace"""
+
+    def __init__(self, trace, interval=0.005, max_depth=40):
+        super().__init__(daemon=True)
+        self.trace = trace
+        self.interval = interval
+        self.max_depth = max_depth
+        self.samples = 0
+        self.stacks = {}
+        self._stop_event = threading.Event()
+
+    def run(self):
+        while not self._stop_event.wait(self.interval):
+            frames = sys._current_frames()
+            with self.trace.lock:
+                thread_ids = list(self.trace.thread_ids)
+            for thread_id in thread_ids:
+                frame = frames.get(thread_id)
+                if frame is None:
+                    continue
+                stack = []
+                while frame is not None and len(stack) < self.max_depth:
+                    code = frame.f_code
+                    stack.append(f"{os.path.basename(code.co_filename)}:{code.co_name}")
+                    frame = frame.f_back
+                collapsed = ';'.join(reversed(stack))
+                self.stacks[collapsed] = self.stacks.get(collapsed, 0) + 1
+                self.samples += 1
+
+    def stop(self):
+        self._stop_event.set()
+        self.join()
+
+    def to_dict(self, top=50):
+        """Most frequent stacks in collapsed (flame graph) format"""
+        stacks = sorted(self.stacks.items(), key=lambda item: item[1], reverse=True)[:top]
+        return {
+            'interval_ms': self.interval * 1000,
+            'samples': self.samples,
+            'stacks': [f"{stack} {count}" for stack, count in stacks],
+        }
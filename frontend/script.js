@@ -1,5 +1,8 @@
 const API_BASE = 'http://127.0.0.1:5000/api';
 
+// Conversation of the last successful query, used for follow-up questions
+let currentConversationId = null;
+
 // Enhanced logging function
 function frontendLog(message, type = "INFO", data = null) {
     const timestamp = new Date().toLocaleTimeString();
@@ -262,6 +265,7 @@ document.head.appendChild(notificationStyle);
 async function sendQuery() {
     const query = document.getElementById('queryInput').value.trim();
     const emailCount = parseInt(document.getElementById('emailCount').value) || 10;
+    const followUp = document.getElementById('followUp').checked && currentConversationId !== null;
 
     frontendLog(`Sending query: "${query}" (analyzing ${emailCount} emails)`, 'API');
     
@@ -297,7 +301,9 @@ async function sendQuery() {
             },
             body: JSON.stringify({ 
                 query: query,
-                max_results: emailCount  // Send the count to backend
+                max_results: emailCount,  // Send the count to backend
+                conversation_id: followUp ? currentConversationId : null,
+                follow_up: followUp
             })
         });
 
@@ -339,6 +345,12 @@ async function sendQuery() {
             return;
         }
 
+        // Remember the conversation so the next question can be a follow-up
+        if (data.conversation_id) {
+            currentConversationId = data.conversation_id;
+            document.getElementById('followUp').disabled = false;
+        }
+
         // Display answer with formatted text
         frontendLog('Formatting and displaying AI response', 'INFO');
         